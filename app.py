@@ -4,6 +4,12 @@ A Streamlit application for medical image analysis
 """
 
 from pathlib import Path
+import hashlib
+import html
+import importlib.util
+import io
+import logging
+import shutil
 import PIL
 from PIL import Image
 import numpy as np
@@ -22,63 +28,7 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# Custom CSS for better UI
-st.markdown("""
-<style>
-    .main-header {
-        font-size: 2.5rem;
-        font-weight: bold;
-        color: #1E88E5;
-        text-align: center;
-        padding: 1rem;
-    }
-    .sub-header {
-        font-size: 1.2rem;
-        color: #666;
-        text-align: center;
-        margin-bottom: 2rem;
-    }
-    .result-box {
-        background-color: #f0f2f6;
-        padding: 1rem;
-        border-radius: 10px;
-        margin: 1rem 0;
-    }
-    .detection-info {
-        background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-        color: white;
-        padding: 1rem;
-        border-radius: 10px;
-        margin: 0.5rem 0;
-    }
-    .stButton>button {
-        width: 100%;
-        background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-        color: white;
-        border: none;
-        padding: 0.75rem 1.5rem;
-        font-size: 1.1rem;
-        border-radius: 10px;
-    }
-    .stButton>button:hover {
-        background: linear-gradient(135deg, #764ba2 0%, #667eea 100%);
-    }
-    .error-box {
-        background-color: #ffebee;
-        border: 1px solid #f44336;
-        padding: 1rem;
-        border-radius: 10px;
-        margin: 1rem 0;
-    }
-    .success-box {
-        background-color: #e8f5e9;
-        border: 1px solid #4caf50;
-        padding: 1rem;
-        border-radius: 10px;
-        margin: 1rem 0;
-    }
-</style>
-""", unsafe_allow_html=True)
+logger = logging.getLogger(__name__)
 
 # Configuration
 ROOT = Path(__file__).resolve().parent
@@ -86,6 +36,16 @@ IMAGES_DIR = ROOT / 'images'
 MODEL_DIR = ROOT / 'weights'
 DEFAULT_IMAGE = IMAGES_DIR / 'STONE- (15).jpg'
 DETECTION_MODEL = MODEL_DIR / 'best.pt'
+APP_CSS = ROOT / 'static' / 'app.css'
+MIN_CONFIDENCE = 0.1
+
+# Custom CSS for better UI
+@st.cache_data
+def load_css(css_path):
+    """Read the app stylesheet once per process"""
+    return Path(css_path).read_text()
+
+st.markdown(f"<style>{load_css(APP_CSS)}</style>", unsafe_allow_html=True)
 
 # Main page heading
 st.markdown('<h1 class="main-header">🏥 Kidney Stone Detection</h1>', unsafe_allow_html=True)
@@ -95,19 +55,118 @@ st.markdown('<p class="sub-header">AI-Powered Medical Image Analysis using Visio
 st.sidebar.image("https://img.icons8.com/fluency/96/kidney.png", width=80)
 st.sidebar.title("⚙️ Configuration")
 
+def model_input_size(model):
+    """Square inference size the model was trained at"""
+    imgsz = model.overrides.get("imgsz", 640)
+    return max(imgsz) if isinstance(imgsz, (list, tuple)) else int(imgsz)
+
 # Model loading with error handling
 @st.cache_resource
 def load_model(model_path):
     """Load YOLO model with comprehensive error handling"""
     try:
+        import torch
         from ultralytics import YOLO
         model = YOLO(str(model_path))
+        imgsz = model_input_size(model)
+        if torch.cuda.is_available():
+            # Run FP16 inference on GPU
+            model.overrides["half"] = True
+        elif importlib.util.find_spec("openvino") is not None:
+            # CPU-only host: run through OpenVINO instead of eager PyTorch
+            # Exports are cached by weights digest so a new best.pt never reuses a stale one
+            digest = hashlib.sha1(model_path.read_bytes()).hexdigest()[:12]
+            openvino_dir = model_path.parent / ".cache" / f"{digest}_openvino_model"
+            try:
+                if not openvino_dir.exists():
+                    # Dynamic shapes so a batch of uploads fits the graph, not just batch 1
+                    exported_dir = model.export(format="openvino", imgsz=imgsz, dynamic=True)
+                    openvino_dir.parent.mkdir(parents=True, exist_ok=True)
+                    shutil.move(exported_dir, openvino_dir)
+                model = YOLO(str(openvino_dir), task="detect")
+                # The exported model carries no imgsz override; keep the one it was exported at
+                model.overrides["imgsz"] = imgsz
+            except Exception:
+                logger.exception("OpenVINO export failed, keeping the PyTorch model")
+                # Don't leave a half-written export behind; the next start retries cleanly
+                shutil.rmtree(openvino_dir, ignore_errors=True)
+                shutil.rmtree(model_path.with_name(f"{model_path.stem}_openvino_model"), ignore_errors=True)
+        # Warm-up pass so the first user request doesn't pay CUDA/cuDNN initialisation
+        model.predict(np.zeros((imgsz, imgsz, 3), dtype=np.uint8), conf=0.9, verbose=False)
+        if torch.cuda.is_available():
+            # The warm-up built and fused the inference backend; switch its weights to NHWC
+            # for the tensor-core conv kernels and re-warm at the new layout
+            model.predictor.model.to(memory_format=torch.channels_last)
+            model.predict(np.zeros((imgsz, imgsz, 3), dtype=np.uint8), conf=0.9, verbose=False)
         return model, None
     except ImportError as e:
         return None, f"ultralytics package not installed: {e}"
     except Exception as e:
         return None, f"Error loading model: {e}"
 
+def decode_upload(source_img, image_format, imgsz):
+    """Decode an upload straight to an RGB image no larger than the inference size"""
+    import torch
+    if image_format == "JPEG" and torch.cuda.is_available():
+        try:
+            import torch.nn.functional as F
+            import torchvision.io as tvio
+            # nvJPEG decode: only the downscaled image is copied back to the host
+            raw = torch.frombuffer(bytearray(source_img.getvalue()), dtype=torch.uint8)
+            img = tvio.decode_jpeg(raw, mode=tvio.ImageReadMode.RGB, device="cuda")
+            height, width = img.shape[1:]
+            ratio = imgsz / max(height, width)
+            if ratio < 1:
+                img = F.interpolate(
+                    img[None].float(),
+                    size=(max(1, round(height * ratio)), max(1, round(width * ratio))),
+                    mode="bilinear",
+                    antialias=True,
+                    align_corners=False
+                )[0].round().clamp(0, 255).to(torch.uint8)
+            return Image.fromarray(img.permute(1, 2, 0).cpu().numpy())
+        except RuntimeError:
+            pass  # fall back to PIL
+    source_img.seek(0)
+    img = Image.open(source_img).convert("RGB")
+    img.thumbnail((imgsz, imgsz), Image.BILINEAR)
+    return img
+
+def run_detection(model, uploads, batch_size):
+    """Detect on the uploads that have no result yet, batching only those misses"""
+    # Results live next to the decoded image in session state, so they are cached per image
+    pending = [upload for upload in uploads if "boxes" not in upload]
+    for start in range(0, len(pending), batch_size):
+        chunk = pending[start:start + batch_size]
+        results = model.predict([upload["image"] for upload in chunk], conf=MIN_CONFIDENCE)
+        for upload, res in zip(chunk, results):
+            upload["frame"] = res.orig_img
+            # FP16 inference returns half-precision boxes; widen before scaling to original pixels
+            upload["boxes"] = res.boxes.data.float().cpu().numpy()
+
+# st.cache_data is shared by every session, so bound how many rendered results it keeps
+@st.cache_data(show_spinner=False, max_entries=64, ttl=3600)
+def render_detection(_frame, _boxes_data, _names, _scale, image_hash, conf):
+    """Filter one image's raw detections by confidence and draw the surviving boxes"""
+    import cv2
+    from ultralytics.utils.plotting import Annotator, colors
+
+    boxes_data = _boxes_data[_boxes_data[:, 4] >= conf]
+    annotator = Annotator(_frame.copy(), example=str(_names))
+    for *xyxy, conf_score, cls_id in boxes_data:
+        label = f"{_names.get(int(cls_id), f'Class {int(cls_id)}')} {conf_score:.2f}"
+        annotator.box_label(xyxy, label, color=colors(int(cls_id), True))
+    # Ship the annotated image as JPEG instead of letting st.image PNG-encode it
+    _, jpeg = cv2.imencode(".jpg", annotator.result(), [cv2.IMWRITE_JPEG_QUALITY, 85])
+    boxes_data = boxes_data.copy()
+    boxes_data[:, :4] *= _scale
+    return jpeg.tobytes(), boxes_data
+
+@st.cache_data
+def load_default_image(image_path):
+    """Decode the sample image once per process"""
+    return Image.open(image_path).convert("RGB") if Path(image_path).exists() else None
+
 # Check model file exists
 model_path = DETECTION_MODEL
 model = None
@@ -120,6 +179,7 @@ else:
     model, model_error = load_model(model_path)
     if model is not None:
         st.sidebar.success("✅ Model loaded successfully")
+        target_size = model_input_size(model)
     else:
         st.sidebar.error(f"❌ {model_error}")
 
@@ -127,31 +187,58 @@ else:
 st.sidebar.markdown("### Detection Settings")
 confidence = st.sidebar.slider(
     "Confidence Threshold",
-    min_value=0.1,
+    min_value=MIN_CONFIDENCE,
     max_value=1.0,
     value=0.4,
     step=0.05,
     help="Higher values = more confident detections only"
 )
 
+batch_size = st.sidebar.slider(
+    "Batch Size",
+    min_value=1,
+    max_value=16,
+    value=4,
+    help="Images per forward pass. GPU memory use grows linearly with batch size"
+)
+
 # Image Upload Section
 st.sidebar.markdown("---")
 st.sidebar.markdown("### 📷 Image Upload")
-source_img = st.sidebar.file_uploader(
-    "Choose an image...",
+source_imgs = st.sidebar.file_uploader(
+    "Choose images...",
     type=("jpg", "jpeg", "png", 'bmp', 'webp'),
-    help="Upload a CT scan or ultrasound image of kidneys"
+    accept_multiple_files=True,
+    help="Upload one or more CT scan or ultrasound images of kidneys"
 )
 
+# Probe each upload's header once per file; pixels are decoded only when detection runs
+decoded_uploads = st.session_state.setdefault("uploads", {})
+for source_img in source_imgs:
+    if source_img.file_id not in decoded_uploads:
+        source_img.seek(0)
+        with Image.open(source_img) as probe:
+            decoded_uploads[source_img.file_id] = {
+                "name": source_img.name,
+                "size": probe.size,
+                "format": probe.format,
+                "mode": probe.mode,
+                "hash": hashlib.sha1(source_img.getvalue()).hexdigest(),
+            }
+uploads = [decoded_uploads[source_img.file_id] for source_img in source_imgs]
+# Drop images that were removed from the uploader
+for file_id in set(decoded_uploads) - {source_img.file_id for source_img in source_imgs}:
+    del decoded_uploads[file_id]
+
 # Main content area
 col1, col2 = st.columns(2)
 
 with col1:
     st.markdown("### 📤 Input Image")
-    if source_img is None:
+    if not uploads:
         # Show default image
-        if DEFAULT_IMAGE.exists():
-            default_image = Image.open(DEFAULT_IMAGE)
+        default_image = load_default_image(DEFAULT_IMAGE)
+        if default_image is not None:
             st.image(default_image, caption="Sample Image - Upload your own image", use_container_width=True)
         else:
             st.info("👆 Please upload an image using the sidebar")
@@ -162,27 +249,34 @@ with col1:
             </div>
             """, unsafe_allow_html=True)
     else:
-        uploaded_image = Image.open(source_img)
-        st.image(uploaded_image, caption="Uploaded Image", use_container_width=True)
+        # JPEG and PNG uploads are served as-is; Streamlit still re-encodes BMP and WebP bytes
+        st.image(
+            [source_img.getvalue() for source_img in source_imgs],
+            caption=[upload["name"] for upload in uploads],
+            use_container_width=True
+        )
         
         # Display image info
+        info_lines = "<br>".join(
+            f"• {upload['name']}: {upload['size'][0]} x {upload['size'][1]} pixels, "
+            f"{upload['format'] or 'Unknown'}, {upload['mode']}"
+            for upload in uploads
+        )
         st.markdown(f"""
         <div class="result-box">
             <strong>Image Info:</strong><br>
-            • Size: {uploaded_image.size[0]} x {uploaded_image.size[1]} pixels<br>
-            • Format: {uploaded_image.format or 'Unknown'}<br>
-            • Mode: {uploaded_image.mode}
+            {info_lines}
         </div>
         """, unsafe_allow_html=True)
 
 with col2:
     st.markdown("### 🔍 Detection Results")
     
-    if source_img is None:
+    if not uploads:
         # Show default detected image or placeholder
-        if DEFAULT_IMAGE.exists():
-            detected_image = Image.open(DEFAULT_IMAGE)
-            st.image(detected_image, caption='Sample Detection Result', use_container_width=True)
+        default_image = load_default_image(DEFAULT_IMAGE)
+        if default_image is not None:
+            st.image(default_image, caption='Sample Detection Result', use_container_width=True)
         else:
             st.markdown("""
             <div style="border: 2px dashed #ccc; padding: 50px; text-align: center; border-radius: 10px;">
@@ -194,50 +288,88 @@ with col2:
         # Detection button
         if st.button('🔬 Detect Kidney Stones', type='primary', use_container_width=True):
             if model is not None:
-                with st.spinner('🔄 Analyzing image...'):
+                with st.spinner('🔄 Analyzing images...'):
                     try:
+                        # Decode each upload once, already downscaled to the inference size
+                        for source_img, upload in zip(source_imgs, uploads):
+                            if "image" not in upload:
+                                upload["image"] = decode_upload(source_img, upload["format"], target_size)
+                        
                         # Run detection
-                        uploaded_image = Image.open(source_img)
-                        res = model.predict(uploaded_image, conf=confidence)
-                        boxes = res[0].boxes
-                        res_plotted = res[0].plot()[:, :, ::-1]
+                        run_detection(model, uploads, batch_size)
+                        names = model.names
+                        # Thresholding happens here, so moving the slider never re-runs the model
+                        plotted_images, boxes_per_image = [], []
+                        for upload in uploads:
+                            # Boxes come back in inference pixels; map them to the original size
+                            # per axis, since each side is rounded separately when downscaling
+                            scale_x = upload["size"][0] / upload["image"].width
+                            scale_y = upload["size"][1] / upload["image"].height
+                            scale = np.array([scale_x, scale_y, scale_x, scale_y], dtype=np.float32)
+                            plotted_image, boxes_data = render_detection(
+                                upload["frame"], upload["boxes"], names, scale, upload["hash"], confidence
+                            )
+                            plotted_images.append(plotted_image)
+                            boxes_per_image.append(boxes_data)
                         
-                        # Display results
-                        st.image(res_plotted, caption='Detection Result', use_container_width=True)
+                        # Display results at their own (inference-sized) width, so nothing is resized
+                        for plotted_image, upload in zip(plotted_images, uploads):
+                            st.image(
+                                plotted_image,
+                                caption=upload["name"],
+                                width=upload["image"].width
+                            )
                         
                         # Detection statistics
-                        num_detections = len(boxes)
+                        num_detections = sum(len(boxes_data) for boxes_data in boxes_per_image)
                         
                         if num_detections > 0:
-                            st.success(f"✅ Found {num_detections} potential kidney stone(s)")
+                            st.success(f"✅ Found {num_detections} potential kidney stone(s) in {len(uploads)} image(s)")
                             
                             # Show detailed results
                             with st.expander("📊 Detailed Detection Results", expanded=True):
-                                for i, box in enumerate(boxes):
-                                    conf_score = float(box.conf[0])
-                                    cls_id = int(box.cls[0])
-                                    
-                                    # Get class name if available
-                                    class_name = model.names.get(cls_id, f"Class {cls_id}") if hasattr(model, 'names') else f"Class {cls_id}"
-                                    
-                                    st.markdown(f"""
-                                    <div class="detection-info">
-                                        <strong>Detection {i+1}:</strong> {class_name}<br>
-                                        <strong>Confidence:</strong> {conf_score:.2%}<br>
-                                        <strong>Bounding Box:</strong> {box.xyxy[0].tolist()}
-                                    </div>
-                                    """, unsafe_allow_html=True)
+                                # Resolve the class-name lookup once, not per box
+                                class_names = names or {}
+                                # Build every card first and emit them in a single markdown call
+                                html_parts = []
+                                for upload, boxes_data in zip(uploads, boxes_per_image):
+                                    if len(boxes_data) == 0:
+                                        continue
+                                    html_parts.append(f"<p><strong>{html.escape(upload['name'])}</strong></p>")
+                                    # Rows are (x1, y1, x2, y2, conf, cls), already on the host
+                                    for i, row in enumerate(boxes_data):
+                                        conf_score = row[4]
+                                        cls_id = int(row[5])
+                                        
+                                        # Get class name if available
+                                        class_name = class_names.get(cls_id, f"Class {cls_id}")
+                                        
+                                        html_parts.append(
+                                            f'<div class="detection-info">'
+                                            f'<strong>Detection {i+1}:</strong> {html.escape(class_name)}<br>'
+                                            f'<strong>Confidence:</strong> {conf_score:.2%}<br>'
+                                            f'<strong>Bounding Box:</strong> {row[:4].tolist()}'
+                                            f'</div>'
+                                        )
+                                st.markdown("\n".join(html_parts), unsafe_allow_html=True)
                             
-                            # Export option
+                            # Export option, one row per box tagged with its 1-based image index
+                            export_rows = np.vstack([
+                                np.column_stack([np.full(len(boxes_data), index), boxes_data])
+                                for index, boxes_data in enumerate(boxes_per_image, start=1)
+                            ])
+                            csv_buffer = io.BytesIO()
+                            np.savetxt(csv_buffer, export_rows, fmt="%.6g", delimiter=",",
+                                       header="image,x1,y1,x2,y2,confidence,class", comments="")
                             st.download_button(
                                 label="📥 Download Detection Results",
-                                data=str(res[0].boxes.data.tolist()),
-                                file_name="detection_results.txt",
-                                mime="text/plain"
+                                data=csv_buffer.getvalue(),
+                                file_name="detection_results.csv",
+                                mime="text/csv"
                             )
                         else:
-                            st.warning("⚠️ No kidney stones detected in this image")
-                            st.info("Try adjusting the confidence threshold or upload a different image")
+                            st.warning("⚠️ No kidney stones detected in the uploaded images")
+                            st.info("Try adjusting the confidence threshold or upload different images")
                     except Exception as e:
                         st.error(f"Error during detection: {e}")
             else:
@@ -262,8 +394,8 @@ st.markdown("""
 st.sidebar.markdown("---")
 st.sidebar.markdown("""
 ### 📖 Instructions
-1. Upload a kidney CT scan or ultrasound image
-2. Adjust confidence threshold if needed
+1. Upload one or more kidney CT scan or ultrasound images
+2. Adjust confidence threshold and batch size if needed
 3. Click 'Detect Kidney Stones'
 4. View and download results
 